@@ -1,22 +1,36 @@
 import argparse
+import asyncio
 import concurrent.futures
-import json
 import logging
 import queue
 import threading
-import codecs
+from typing import List, Optional, Tuple
 from urllib.parse import urlparse, urljoin
 
-from bs4 import BeautifulSoup
+import aiohttp
+import lxml.html
+import orjson
+import zstandard
 from selenium import webdriver
 from selenium.webdriver.chrome.service import Service
 
-from sqlalchemy import create_engine, Column, Integer, String, Text
-from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy import create_engine, event, select, update, Column, Index, Integer, LargeBinary, String, TypeDecorator
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import sessionmaker, scoped_session, declarative_base
+from sqlalchemy.pool import QueuePool
 
 # Set the path to the chromedriver.exe file
 CHROME_DRIVER_PATH = "/usr/local/bin/chromedriver"
 
+# Maximum number of rows written to the database in a single transaction
+DB_BATCH_SIZE = 500
+
+# Bodies shorter than this are assumed to be JS-rendered and are refetched with Selenium
+MIN_HTML_LENGTH = 512
+
+# Timeout in seconds for a single HTTP fetch
+FETCH_TIMEOUT = 30
+
 # Configure the logging module
 logging.basicConfig(
     level=logging.INFO,
@@ -30,35 +44,69 @@ logging.basicConfig(
 # Create a lock object to synchronize access to the log file
 log_lock = threading.Lock()
 
-# Custom JSON encoder class
-class SetEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, set):
-            return list(obj)
-        return super().default(obj)
-
 # Create the engine and sessionmaker objects
 engine = None
 Session = None
 
-def create_database(db_file):
+def create_database(db_file, max_threads=10):
     global engine, Session
-    engine = create_engine(f"sqlite:///{db_file}", connect_args={'check_same_thread': False})
-    Session = sessionmaker(bind=engine)
-    # Create the pages table if it does not exist
+    # Give each worker thread its own pooled connection instead of funnelling
+    # everything through a single shared one; the extra two connections cover
+    # the main thread and the database insert thread
+    engine = create_engine(
+        f"sqlite:///{db_file}",
+        connect_args={'check_same_thread': False},
+        poolclass=QueuePool,
+        pool_size=max_threads + 2,
+        max_overflow=0,
+        pool_recycle=3600
+    )
+
+    # Tune SQLite for write-heavy use on every new connection
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute("PRAGMA mmap_size=268435456")
+        cursor.close()
+
+    Session = scoped_session(sessionmaker(bind=engine))
+    # Create the pages table if it does not exist, before any threads start
     Base.metadata.create_all(engine)
 
 # Create the declarative base for defining the ORM classes
 Base = declarative_base()
 
+# Column type that stores a JSON-serializable value as zstd-compressed bytes;
+# link lists are highly repetitive text, so this shrinks them several-fold
+class CompressedJSON(TypeDecorator):
+    impl = LargeBinary
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        if isinstance(value, set):
+            value = list(value)
+        return zstandard.ZstdCompressor(level=3).compress(orjson.dumps(value))
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return orjson.loads(zstandard.ZstdDecompressor().decompress(value))
+
 # Define the ORM class for the 'pages' table
 class Page(Base):
     __tablename__ = 'pages'
     url = Column(String, primary_key=True)
-    source_url = Column(String)
-    depth = Column(Integer)
+    source_url = Column(String, index=True)
+    depth = Column(Integer, index=True)
     title = Column(String)
-    links = Column(Text)
+    links = Column(CompressedJSON)
+
+    __table_args__ = (Index('ix_source_depth', 'source_url', 'depth'),)
 
     def __init__(self, url, source_url, depth, title, links):
         self.url = url
@@ -73,13 +121,20 @@ class Page(Base):
 class Scraper:
     def __init__(self, initial_url, max_depth, db_file=None, max_threads=10):
         self.initial_url = initial_url
+        self.initial_netloc = urlparse(initial_url).netloc
         self.max_depth = max_depth
         self.db_file = db_file or 'scraper.db'
         self.db_insert_queue = queue.Queue()
         self.max_threads = max_threads
         self.visited_urls = set()
+        # visited_urls is read from executor threads while the event loop
+        # adds to it, so the check-and-insert must be atomic
+        self._visited_lock = threading.Lock()
         self.connection_pool = queue.Queue(maxsize=max_threads)
 
+        # One persistent pool for parsing and Selenium fallback work
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_threads)
+
         # Configure the Chrome driver
         CHROME_OPTIONS = webdriver.ChromeOptions()
         CHROME_OPTIONS.add_argument("--headless")
@@ -88,18 +143,35 @@ class Scraper:
         CHROME_OPTIONS.add_argument("--disable-browser-side-navigation")
         CHROME_OPTIONS.add_argument("--disable-infobars")
         CHROME_OPTIONS.add_argument("--disable-extensions")
-
-        # Set up the Selenium web driver
-        self.service = Service(CHROME_DRIVER_PATH)
-        self.service.start()
-        self.driver = webdriver.Remote(
-            self.service.service_url,
-            desired_capabilities=CHROME_OPTIONS.to_capabilities()
-        )
-
-        create_database(self.db_file)
+        # Return as soon as the DOM is ready instead of waiting for subresources,
+        # and don't download images or stylesheets at all
+        CHROME_OPTIONS.page_load_strategy = 'eager'
+        CHROME_OPTIONS.add_experimental_option("prefs", {
+            "profile.managed_default_content_settings.images": 2,
+            "profile.managed_default_content_settings.stylesheets": 2
+        })
+
+        # Set up a pool of Selenium web drivers, one per worker thread, since
+        # a single driver cannot be shared safely across threads
+        self.driver_pool = queue.Queue()
+        for _ in range(max_threads):
+            driver = webdriver.Chrome(
+                service=Service(CHROME_DRIVER_PATH), options=CHROME_OPTIONS)
+            self.driver_pool.put(driver)
+
+        create_database(self.db_file, self.max_threads)
+
+        # Seed the dedup set with every URL already in the database so known
+        # pages are skipped without a query
+        with Session() as session:
+            self.visited_urls.update(session.execute(select(Page.url)).scalars())
 
     def start_scraping(self):
+        # Start the thread for inserting scraped data into the database before
+        # scraping begins, so rows are written while the crawl is running
+        self.db_insert_thread = threading.Thread(target=self.run_db_inserts, daemon=True)
+        self.db_insert_thread.start()
+
         # Check if the database already has some URLs scraped
         with Session() as session:
             count = session.query(Page).filter_by(url=self.initial_url).count()
@@ -111,11 +183,7 @@ class Scraper:
         else:
            logging.info(
                 f"Start Scraping from {self.initial_url} with max depth of {self.max_depth}")
-           self.scrape(self.initial_url, depth=0)
-
-        # Start the thread for inserting scraped data into the database
-        db_insert_thread = threading.Thread(target=self.run_db_inserts)
-        db_insert_thread.start()
+           asyncio.run(self.crawl(self.initial_url, depth=0))
 
     def resume_scraping(self):
         # Find the last page scraped and its depth for the initial URL
@@ -133,137 +201,224 @@ class Scraper:
             logging.info(f"All data has been scraped for URL: {self.initial_url}")
             return
 
-        # Skip URLs until the last URL is reached
-        while self.url_queue.qsize() > 0:
-            url, depth = self.url_queue.get()
-            if url == last_url:
-                self.url_queue.put((url, depth))
-                break
-
-        self.visited_urls.add(last_url)
-
         with log_lock:
             logging.info(f"Resuming scraping from {last_url}, depth={last_depth}")
 
-        # Continue scraping from the last page scraped
-        self.scrape(last_url, last_depth)
-
-    def scrape(self, url, depth):
-        if depth > self.max_depth:
-            return
-
-        if url in self.visited_urls:
-            return
-        self.visited_urls.add(url)
+        # The resume URL was preloaded into the dedup set from the database;
+        # drop it so the crawl does not skip its own starting point
+        self.visited_urls.discard(last_url)
 
+        # Continue scraping from the last page scraped
+        asyncio.run(self.crawl(last_url, last_depth))
+
+    async def crawl(self, url: str, depth: int) -> None:
+        # Breadth-first crawl: fetch each level of the frontier concurrently
+        connector = aiohttp.TCPConnector(limit=self.max_threads, ttl_dns_cache=300)
+        semaphore = asyncio.Semaphore(self.max_threads)
+        async with aiohttp.ClientSession(connector=connector) as http_session:
+            frontier = [(url, depth)]
+            while frontier:
+                tasks = []
+                for url, depth in frontier:
+                    with self._visited_lock:
+                        if url in self.visited_urls:
+                            continue
+                        self.visited_urls.add(url)
+                    tasks.append(self.scrape(http_session, semaphore, url, depth))
+
+                if not tasks:
+                    break
+                results = await asyncio.gather(*tasks)
+
+                frontier = [
+                    (link, depth + 1)
+                    for links, depth in results
+                    for link in links
+                    if depth + 1 <= self.max_depth
+                ]
+
+    async def fetch(self, http_session: aiohttp.ClientSession,
+                    semaphore: asyncio.Semaphore, url: str) -> Tuple[Optional[str], str]:
+        async with semaphore:
+            timeout = aiohttp.ClientTimeout(total=FETCH_TIMEOUT)
+            async with http_session.get(url, timeout=timeout) as response:
+                # Don't read the body of non-HTML resources at all
+                if "html" not in response.headers.get("Content-Type", ""):
+                    return None, str(response.url)
+                return await response.text(), str(response.url)
+
+    async def scrape(self, http_session: aiohttp.ClientSession,
+                     semaphore: asyncio.Semaphore, url: str, depth: int) -> Tuple[List[str], int]:
         try:
-            self.driver.get(url)
+            html, current_url = await self.fetch(http_session, semaphore, url)
         except Exception as e:
             with log_lock:
                 logging.error(f"Error scraping {url}: {e}")
-            return
-
-        soup = BeautifulSoup(self.driver.page_source, "lxml")
-        title = soup.title.string.strip()
-
-        links = self.get_links(soup, url)
-
-        result = (url, self.driver.current_url, depth, title, links)
+            return [], depth
+
+        # Non-HTML resources (PDFs, images, archives) get a minimal row so they
+        # are not refetched, and skip parsing and the Selenium fallback
+        if html is None:
+            self.save_to_db((url, current_url, depth, "", []))
+            return [], depth
+
+        loop = asyncio.get_event_loop()
+
+        # Pages with suspiciously short bodies are assumed to need JS rendering,
+        # so refetch them through the Selenium driver
+        if len(html) < MIN_HTML_LENGTH:
+            try:
+                html, current_url = await loop.run_in_executor(
+                    self.executor, self.fetch_with_selenium, url)
+            except Exception as e:
+                with log_lock:
+                    logging.error(f"Error scraping {url} with Selenium: {e}")
+                return [], depth
+
+        # Parse in a worker thread to keep the event loop unblocked
+        title, links = await loop.run_in_executor(
+            self.executor, self.parse, html, current_url)
+
+        result = (url, current_url, depth, title, links)
         self.save_to_db(result)
 
         with log_lock:
             logging.info(
                 f"Scraped {url}, depth={depth}, title='{title}'")
 
-        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_threads) as executor:
-            futures = [executor.submit(
-                self.scrape, link, depth + 1) for link in links if depth + 1 <= self.max_depth]
-            concurrent.futures.wait(futures)
-
-    def get_links(self, soup, url):
-        links = []
-        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_threads) as executor:
-            futures = []
-            for link in soup.find_all("a"):
-                href = link.get("href")
-                if href:
-                    # If the link is a relative URL, add the initial URL's domain to the beginning
-                    if href.startswith("/"):
-                        href = urljoin(self.initial_url, href)
-                    # If the link is missing the initial URL's domain, add it to the beginning
-                    elif not href.startswith("http"):
-                        href = urljoin(self.initial_url, href)
-                    future = executor.submit(self.get_link, href)
-                    futures.append(future)
-            for future in concurrent.futures.as_completed(futures):
-                links += future.result()
-        return links
+        return links, depth
 
-    def get_link(self, href):
+    def fetch_with_selenium(self, url: str) -> Tuple[str, str]:
+        # Check a driver out of the pool for the duration of the fetch
+        driver = self.driver_pool.get()
+        try:
+            driver.get(url)
+            return driver.page_source, driver.current_url
+        finally:
+            self.driver_pool.put(driver)
+
+    def parse(self, html: str, current_url: str) -> Tuple[str, List[str]]:
+        doc = lxml.html.fromstring(html)
+        title = (doc.findtext(".//title") or "").strip()
+        links = self.get_links(doc.xpath("//a/@href"), current_url)
+        return title, links
+
+    def get_links(self, raw_hrefs: List[str], url: str) -> List[str]:
+        hrefs = []
+        for href in raw_hrefs:
+            # If the link is relative, resolve it against the initial URL
+            if not urlparse(href).scheme:
+                href = urljoin(self.initial_url, href)
+            hrefs.append(href)
+
+        # Deduplicate while preserving order, and skip URLs already seen in
+        # memory or pointing at other domains before touching the database
+        candidates = []
+        for href in dict.fromkeys(hrefs):
+            with self._visited_lock:
+                if href in self.visited_urls:
+                    continue
+            if urlparse(href).netloc == self.initial_netloc:
+                candidates.append(href)
+
+        if not candidates:
+            return []
+        return self.get_link_batch(candidates, url)
+
+    def get_link_batch(self, hrefs: List[str], source_url: str) -> List[str]:
         links = []
         try:
-            parsed_url = urlparse(href)
-            # Only follow links to the same domain
-            if parsed_url.netloc == urlparse(self.initial_url).netloc:
-                with Session() as session:
-                    # Check if the URL is already in the database
-                    page = session.query(Page).filter_by(url=href).first()
-                    if page is None:
-                        # If the URL is not in the database, add it to the URL queue
+            with Session() as session:
+                # Look up all candidates in a single query instead of one per link
+                rows = session.execute(
+                    select(Page.url, Page.depth).where(Page.url.in_(hrefs))).all()
+                existing = dict(rows)
+
+                deepen = []
+                for href in hrefs:
+                    if href not in existing:
+                        # If the URL is not in the database, add it to the URL
+                        # queue and hand its stub row to the background writer
+                        # instead of committing it here
                         links.append(href)
-                        page = Page(url=href, source_url=self.driver.current_url, depth=0, title="", links=set())
-                        session.add(page)
-                        session.commit()
-                    elif page.depth < self.max_depth:
+                        self.db_insert_queue.put((href, source_url, 0, "", []))
+                    elif existing[href] < self.max_depth:
                         # If the URL is in the database and its depth is less than the max depth, add it to the URL queue
                         links.append(href)
-                        page.depth += 1
-                        session.merge(page)
-                        session.commit()
+                        deepen.append(href)
+
+                if deepen:
+                    session.execute(
+                        update(Page).where(Page.url.in_(deepen)).values(depth=Page.depth + 1))
+                    session.commit()
         except Exception as e:
             with log_lock:
-                logging.error(f"Error parsing URL {href}: {e}")
+                logging.error(f"Error processing links from {source_url}: {e}")
         return links
 
     def save_to_db(self, result):
         self.db_insert_queue.put(result)
 
     def run_db_inserts(self):
-        with Session() as session:
-            while True:
-                try:
-                    result = self.db_insert_queue.get()
+        # Upsert in place rather than INSERT OR REPLACE, which deletes and
+        # reinserts the row; values come from the executemany parameters
+        insert_stmt = sqlite_insert(Page.__table__)
+        upsert_stmt = insert_stmt.on_conflict_do_update(
+            index_elements=['url'],
+            set_={
+                'source_url': insert_stmt.excluded.source_url,
+                'depth': insert_stmt.excluded.depth,
+                'title': insert_stmt.excluded.title,
+                'links': insert_stmt.excluded.links
+            }
+        )
+        done = False
+        while not done:
+            # Block for the first item, then drain the queue up to the batch size
+            batch = [self.db_insert_queue.get()]
+            if batch[0] is None:
+                break
+            try:
+                while len(batch) < DB_BATCH_SIZE:
+                    result = self.db_insert_queue.get_nowait()
                     if result is None:
+                        # Stop after flushing the final partial batch
+                        done = True
                         break
-                    url, source_url, depth, title, links = result
-    
-                    # Encode the title string using UTF-8 encoding
-                    title_encoded = codecs.encode(title, 'utf-8')
-    
-                    # Check if links are already serialized to JSON
-                    if not isinstance(links, str):
-                        links = json.dumps(links, cls=SetEncoder)
-    
-                    page = Page(
-                        url=url,
-                        source_url=source_url,
-                        depth=depth,
-                        title=title_encoded,
-                        links=links
-                    )
-                    session.merge(page)
-                    session.commit()
-                except Exception as e:
-                    with log_lock:
-                        logging.error(f"Error saving {url} to database: {e}")
-                    session.rollback()
+                    batch.append(result)
+            except queue.Empty:
+                pass
+
+            rows = []
+            for url, source_url, depth, title, links in batch:
+                # Serialization and compression happen in the CompressedJSON
+                # column type when the row is bound
+                rows.append({
+                    "url": url,
+                    "source_url": source_url,
+                    "depth": depth,
+                    "title": title,
+                    "links": links
+                })
+
+            try:
+                # Write the whole batch in a single transaction
+                with engine.begin() as connection:
+                    connection.execute(upsert_stmt, rows)
+            except Exception as e:
+                with log_lock:
+                    logging.error(f"Error saving batch of {len(rows)} pages to database: {e}")
 
     def cleanup(self):
-        self.driver.quit()
-        self.service.stop()
+        self.executor.shutdown(wait=True)
+        while not self.driver_pool.empty():
+            self.driver_pool.get().quit()
 
-        # Insert None into the queue to signal the database insertion thread to exit
+        # Insert None into the queue to signal the database insertion thread to
+        # exit, and wait for it to flush the remaining batches
         self.db_insert_queue.put(None)
+        self.db_insert_thread.join()
+        Session.remove()
         engine.dispose()
 
 